@@ -3,13 +3,19 @@
 module for performing simple extract-load operations from mssql to redshift
 """
 
-import csv
-import os
+import io
 import gzip as gz
 import json
 import argparse
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime
 from dateutil import parser
 from cocore.config import Config
@@ -20,6 +26,551 @@ from cocloud.s3_interaction import S3Interaction
 
 LOG = Logger()
 
+FETCH_BLOCKSIZE = 20000
+# s3 requires every part but the last to be at least 5MB
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+# fetched blocks / encoded parts held between pipeline stages, bounds memory use
+PIPELINE_DEPTH = 4
+UPLOAD_THREADS = 4
+# lower bound on rows per file when splitting an extract across redshift slices,
+# extracts up to this size are written as a single file
+MIN_ROWS_PER_PART = 100000
+# default install locations of microsoft's bcp on linux
+MSSQL_TOOLS_PATHS = ('/opt/mssql-tools18/bin', '/opt/mssql-tools/bin')
+KEEP_ALIVE_INTERVAL = 60
+# connections checked more recently than this are assumed to still be open
+CONNECTION_CHECK_INTERVAL = KEEP_ALIVE_INTERVAL
+# level 1 is several times cheaper than the default of 9 for a few percent larger output
+GZIP_COMPRESSLEVEL = 1
+# characters that would break a row or column in the delimited output
+_TSV_SPECIAL_CHARS = ('\n', '\t', '\r', '\v')
+_TSV_TRANS = str.maketrans(dict.fromkeys(_TSV_SPECIAL_CHARS, ' '))
+# joins a column for the single pass translate, left alone by _TSV_TRANS
+_TSV_SEPARATOR = '\x1f'
+_BOOL_STRINGS = {True: '1', False: '0', None: 'None'}
+
+# source type names as reported by information_schema, grouped by redshift mapping
+_RS_DATE_TYPES = frozenset({'timestamp with time zone', 'time without time zone',
+                            'datetime', 'smalldatetime', 'date', 'datetime2'})
+_RS_CHAR_TYPES = frozenset({'timestamp', 'char', 'varchar', 'character', 'nchar', 'bpchar',
+                            'character varying', 'nvarchar', 'text'})
+_RS_NUM_TYPES = frozenset({'decimal', 'numeric'})
+_RS_SMALLINT_TYPES = frozenset({'bit', 'tinyint', 'smallint', 'int2'})
+_RS_INT_TYPES = frozenset({'int', 'integer', 'int4'})
+_RS_BIGINT_TYPES = frozenset({'bigint', 'int8'})
+_RS_OTHER_TYPES = frozenset({'real', 'double precision',
+                             'boolean', 'float4', 'float8',
+                             'float', 'date', 'bool',
+                             'timestamp without time zone'})
+_RS_RESERVED_NAMES = frozenset({'partition'})
+# source types whose values are written without sanitizing
+_BOOL_TYPES = frozenset({'bit', 'boolean', 'bool'})
+_PLAIN_TYPES = (_RS_DATE_TYPES | _RS_NUM_TYPES | _RS_SMALLINT_TYPES | _RS_INT_TYPES | _RS_BIGINT_TYPES
+                | frozenset({'real', 'float', 'float4', 'float8', 'double precision',
+                             'money', 'smallmoney', 'uniqueidentifier', 'timestamp without time zone'})) - _BOOL_TYPES
+# etl metadata columns appended to every staged table, see rSqoop.meta_fields
+_RS_META_COLUMNS = ('etl_source_system_cd varchar(50) encode zstd',
+                    'etl_row_create_dts timestamp encode az64',
+                    'etl_row_update_dts timestamp encode az64',
+                    'etl_run_id bigint encode az64')
+# redshift type -> column compression, anything not listed (char/varchar
+# and the float types az64 does not support) is encoded zstd
+_RS_ENCODINGS = dict.fromkeys(('smallint', 'integer', 'bigint', 'int2', 'int4', 'int8', 'decimal', 'numeric',
+                               'date', 'timestamp', 'timestamp without time zone'), 'az64')
+_RS_ENCODINGS.update(dict.fromkeys(('boolean', 'bool'), 'raw'))
+
+
+def _rs_char_type(field):
+    """
+    Maps a character source field to a redshift type, keeping its precision
+
+    :param field: schema tuple
+    :return: str
+    """
+    if field[1] == "text" or field[1] == "timestamp":
+        field_type = "varchar"
+    else:
+        field_type = field[1]
+
+    if field[1] == "timestamp":
+        size = 8
+    elif int(field[2]) > 65535:
+        size = 65535
+    elif int(field[2]) < 0:
+        size = 2000
+    else:
+        size = field[2]
+    return ('%s (%s)' % (field_type, size) if field[1] == 'timestamp' or field[2] is not None
+            else 'varchar(2000)')
+
+
+def _rs_num_type(field):
+    """
+    Maps a numeric source field to a redshift type, keeping its precision
+
+    :param field: schema tuple
+    :return: str
+    """
+    return ('%s (%s,%s)' % (field[1], field[3], field[4]) if field[3] is not None
+            else field[1])
+
+
+# source type -> handler returning the redshift type, built from the lowest
+# precedence group up so a type listed in several groups keeps the first
+# match of the original if/elif ladder (e.g. date -> timestamp)
+_RS_TYPE_HANDLERS = {'uniqueidentifier': lambda field: 'varchar(36)'}
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_OTHER_TYPES, lambda field: field[1]))
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_NUM_TYPES, _rs_num_type))
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_BIGINT_TYPES, lambda field: 'bigint'))
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_INT_TYPES, lambda field: 'integer'))
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_SMALLINT_TYPES, lambda field: 'smallint'))
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_CHAR_TYPES, _rs_char_type))
+_RS_TYPE_HANDLERS['uuid'] = lambda field: 'varchar(50)'
+_RS_TYPE_HANDLERS.update(dict.fromkeys(_RS_DATE_TYPES, lambda field: 'timestamp'))
+
+
+def _rs_encoding(data_type):
+    """
+    Picks the column compression for a redshift type
+
+    :param data_type: redshift type as built by _RS_TYPE_HANDLERS, e.g. 'varchar (100)'
+    :return: str
+    """
+    return _RS_ENCODINGS.get(data_type.split('(')[0].strip(), 'zstd')
+
+
+# s3_to_redshift copy statements, filled in with %-style substitution
+_PRE_SQL = """delete from %(tgt_table)s;\n"""
+_PRE_SQL_INC = """
+                drop table if exists tmp;
+                create temporary table tmp (like %(tgt_table)s);\n"""
+_UPD_SQL_INC = """
+                delete
+                from %(tgt_table)s
+                where exists
+                  ( select 1
+                    from tmp
+                    where %(upd_where)s);
+                insert into %(tgt_table)s
+                select * from tmp;\n"""
+
+_CP_SQL_CSV = _PRE_SQL + """
+                COPY %(tgt_table)s from '%(s3_path)s'
+                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
+                dateformat 'YYYY-MM-DD'
+                NULL AS 'None'
+                truncatecolumns
+                maxerror %(maxerror)s
+                %(options)s;\n"""
+_CP_SQL_DELIM = _PRE_SQL + """
+                COPY %(tgt_table)s from '%(s3_path)s'
+                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
+                delimiter '%(delimiter)s'
+                dateformat 'YYYY-MM-DD'
+                NULL AS 'None'
+                truncatecolumns
+                maxerror %(maxerror)s
+                %(options)s;\n"""
+_CP_SQL_CSV_INC = _PRE_SQL_INC + """
+                COPY tmp from '%(s3_path)s'
+                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
+                dateformat 'YYYY-MM-DD'
+                NULL AS 'None'
+                truncatecolumns
+                maxerror %(maxerror)s %(options)s;\n""" + _UPD_SQL_INC
+_CP_SQL_DELIM_INC = _PRE_SQL_INC + """
+                COPY tmp from '%(s3_path)s'
+                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
+                delimiter '%(delimiter)s'
+                dateformat 'YYYY-MM-DD'
+                NULL AS 'None'
+                truncatecolumns
+                maxerror %(maxerror)s %(options)s;\n""" + _UPD_SQL_INC
+
+
+def _iter_blocks(rows, blocksize=FETCH_BLOCKSIZE):
+    """
+    Groups a row iterator into lists of at most blocksize rows
+
+    :param rows: iterable of rows
+    :param blocksize: int
+    :return: generator of lists
+    """
+    rows = iter(rows)
+    block = list(islice(rows, blocksize))
+    while block:
+        yield block
+        block = list(islice(rows, blocksize))
+
+
+def _encode_text(col):
+    values = [str(v) for v in col]
+    # one C level scan of the whole column is far cheaper than translating
+    # every value, and most columns have nothing to replace
+    joined = _TSV_SEPARATOR.join(values)
+    if any(c in joined for c in _TSV_SPECIAL_CHARS):
+        # translate the column in one pass and split it back apart, unless
+        # a value contained the separator itself
+        translated = joined.translate(_TSV_TRANS).split(_TSV_SEPARATOR)
+        values = translated if len(translated) == len(values) else [v.translate(_TSV_TRANS) for v in values]
+    return values
+
+
+def _encode_bool(col):
+    return list(map(_BOOL_STRINGS.get, col))
+
+
+def _encode_plain(col):
+    return [str(v) for v in col]
+
+
+def _column_encoders(schema):
+    """
+    Picks an encoder for every column of the extract from its source type
+
+    Numeric and date values can't contain delimiters or line breaks, so
+    they skip the translate pass entirely.
+
+    :param schema: list of schema tuples, in select order
+    :return: list of functions, each taking a column tuple and returning a list
+    """
+    encoders = []
+    for field in schema:
+        if field[1] in _BOOL_TYPES:
+            encoders.append(_encode_bool)
+        elif field[1] in _PLAIN_TYPES:
+            encoders.append(_encode_plain)
+        else:
+            encoders.append(_encode_text)
+    return encoders
+
+
+def _guess_encoder(col):
+    # column types are fixed by the source table, so the first
+    # non null value is enough to pick the conversion
+    sample = next((v for v in col if v is not None), None)
+    return _encode_bool if isinstance(sample, bool) else _encode_text
+
+
+def _sanitize_block(block, delimiter, meta_tail, encoders=None):
+    """
+    Renders a block of source rows as delimited text
+
+    The block is transposed so each column is converted in one pass,
+    then zipped back into delimited lines ending with the etl metadata.
+
+    :param block: list of rows
+    :param delimiter: str
+    :param meta_tail: delimiter, etl metadata values and line end, see _meta_tail
+    :param encoders: column encoders from _column_encoders, guessed from the values if not given
+    :return: str
+    """
+    cols = list(zip(*block))
+    if encoders is None or len(encoders) != len(cols):
+        encoders = [_guess_encoder(col) for col in cols]
+    cols = [encode(col) for encode, col in zip(encoders, cols)]
+
+    return meta_tail.join(map(delimiter.join, zip(*cols))) + meta_tail
+
+
+def _meta_tail(meta_values, delimiter):
+    """
+    Serializes the etl metadata once per extract, it is the same for every row
+
+    :param meta_values: list of etl metadata values
+    :param delimiter: str
+    :return: str
+    """
+    return delimiter + delimiter.join(str(v) for v in meta_values) + '\n'
+
+
+@lru_cache(maxsize=None)
+def _find_bcp():
+    """
+    Locates the sql server bcp utility, other tools (e.g. boost) ship a bcp binary too
+
+    Looked up once per process and shared by every table of the run.
+
+    :return: str path or None
+    """
+    candidates = [shutil.which('bcp')] + [shutil.which('bcp', path=path) for path in MSSQL_TOOLS_PATHS]
+    for candidate in candidates:
+        if not candidate:
+            continue
+        try:
+            version = subprocess.run([candidate, '-v'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     timeout=10).stdout
+        except (OSError, subprocess.SubprocessError):
+            continue
+        if b'Bulk Copy Program' in version:
+            return candidate
+    return None
+
+
+def _bcp_select_expr(field):
+    """
+    Renders a source column for bcp the way the python export would write it
+
+    Nulls become 'None' and line breaks/delimiters are replaced server side.
+
+    :param field: schema tuple
+    :return: str, sql expression
+    """
+    column = '[' + str(field[0]).replace(']', ']]') + ']'
+    if field[1] in _BOOL_TYPES:
+        expr = f'cast({column} as varchar(1))'
+    elif field[1] in _RS_DATE_TYPES:
+        expr = f'convert(varchar(33), {column}, 121)'
+    elif field[1] in ('real', 'float'):
+        expr = f'convert(varchar(30), {column}, 2)'
+    elif field[1] in ('money', 'smallmoney'):
+        expr = f'convert(varchar(32), {column}, 2)'
+    elif field[1] in _PLAIN_TYPES:
+        expr = f'cast({column} as varchar(64))'
+    else:
+        expr = f'cast({column} as nvarchar(max))'
+        for char_code in (10, 13, 9, 11):
+            expr = f"replace({expr}, char({char_code}), ' ')"
+    return f"isnull({expr}, 'None')"
+
+
+def _index_select_fields(select_fields):
+    """
+    Indexes user selected fields by lower cased source field name
+
+    :param select_fields: list of tuple [(<source_field>, <override_field>), <source_field>]
+    :return: dict
+    """
+    index = {}
+    for item in select_fields:
+        key = item[0] if isinstance(item, tuple) else item
+        index.setdefault(str(key).lower(), item)
+    return index
+
+
+def _prefetch(iterable, maxsize=PIPELINE_DEPTH):
+    """
+    Iterates over iterable in a background thread, keeping up to maxsize items ready
+
+    Lets the source fetch run while the caller is still encoding and
+    uploading the previous items. Errors in the background thread are
+    raised in the caller. Closing the generator waits for the background
+    thread to stop, so the source can be reused right after.
+
+    :param iterable:
+    :param maxsize: int
+    :return: generator
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+class _S3MultipartWriter(io.RawIOBase):
+    """
+    Write only stream that uploads to an s3 key as a multipart upload
+
+    Parts are handed to a small pool of upload threads through a bounded
+    queue, so uploading overlaps with whatever is producing the data.
+    Only complete() publishes the object. close(), which wrappers and
+    garbage collection call implicitly, aborts an unfinished upload.
+    """
+    def __init__(self, client, bucket, key, part_size=MULTIPART_PART_SIZE,
+                 threads=UPLOAD_THREADS, queue_size=PIPELINE_DEPTH):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.parts = []
+        self._buffer = bytearray()
+        self._part_number = 0
+        self._aborted = False
+        self._error = None
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._uploaders = [threading.Thread(target=self._upload_parts, daemon=True) for _ in range(threads)]
+        for uploader in self._uploaders:
+            uploader.start()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        if len(self._buffer) >= self.part_size:
+            self._queue_part()
+        return len(b)
+
+    def _queue_part(self):
+        if self._error is not None:
+            raise self._error
+        self._part_number += 1
+        self._queue.put((self._part_number, bytes(self._buffer)))
+        self._buffer = bytearray()
+
+    def _upload_parts(self):
+        while True:
+            part = self._queue.get()
+            if part is None:
+                return
+            # keep draining after a failure so the producer never blocks
+            if self._error is not None or self._aborted:
+                continue
+            part_number, body = part
+            try:
+                response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                   PartNumber=part_number, Body=body)
+                self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            except Exception as e:
+                self._error = e
+
+    def _stop_uploaders(self):
+        for _ in self._uploaders:
+            self._queue.put(None)
+        for uploader in self._uploaders:
+            uploader.join()
+        self._uploaders = []
+
+    def complete(self):
+        """
+        Uploads whatever is left as the last part and completes the upload
+        """
+        if self.closed:
+            raise ValueError('upload already closed')
+        try:
+            if self._buffer or self._part_number == 0:
+                self._queue_part()
+            self._stop_uploaders()
+            if self._error is not None:
+                raise self._error
+            self.parts.sort(key=lambda part: part['PartNumber'])
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        except BaseException:
+            self.abort()
+            raise
+        super().close()
+
+    def close(self):
+        """
+        Aborts the upload unless complete() already finished it
+        """
+        self.abort()
+
+    def abort(self):
+        """
+        Discards the parts uploaded so far
+        """
+        if self.closed:
+            return
+        self._aborted = True
+        self._stop_uploaders()
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+
+class _S3TsvWriter(object):
+    """
+    Delimited, optionally gzipped, output streamed to a single s3 key
+    """
+    def __init__(self, client, bucket, key, meta_tail, delimiter='\t', gzip=True):
+        self.url = f's3://{bucket}/{key}'
+        self.rows = 0
+        self.meta_tail = meta_tail
+        self.delimiter = delimiter
+        self._s3_stream = _S3MultipartWriter(client, bucket, key)
+        self._buffered = io.BufferedWriter(self._s3_stream, buffer_size=WRITE_BUFFER_SIZE)
+        self._out_file = gz.GzipFile(fileobj=self._buffered, mode='wb', compresslevel=GZIP_COMPRESSLEVEL) if gzip \
+            else self._buffered
+
+    def write_block(self, block, encoders=None):
+        """
+        Writes a fetch block in a single write call
+
+        :param block: list of rows
+        :param encoders: column encoders from _column_encoders
+        """
+        self._out_file.write(_sanitize_block(block, self.delimiter, self.meta_tail, encoders).encode('utf-8'))
+        self.rows += len(block)
+
+    def write_lines(self, lines):
+        """
+        Writes lines that are already delimited, as produced by bcp
+
+        :param lines: list of bytes, one per row
+        """
+        # bcp character mode writes empty strings as a single NUL
+        self._out_file.write(b''.join(lines).replace(b'\x00', b''))
+        self.rows += len(lines)
+
+    def close(self):
+        # gzip leaves its fileobj open, closing the buffered writer would abort the upload
+        if self._out_file is not self._buffered:
+            self._out_file.close()
+        self._buffered.flush()
+        self._s3_stream.complete()
+        self._buffered.close()
+
+    def abort(self):
+        self._s3_stream.abort()
+
+
+class _KeepAlive(threading.Thread):
+    """
+    Pings an idle connection in the background so it isn't dropped during long extracts
+    """
+    def __init__(self, ping, interval=KEEP_ALIVE_INTERVAL):
+        super().__init__(daemon=True)
+        self.ping = ping
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.ping()
+            except Exception as e:
+                LOG.l(f'keep alive failed: {e}')
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
 
 class rSqoop(object):
     """
@@ -36,8 +587,6 @@ class rSqoop(object):
             'etl_row_update_dts': None,
             'etl_run_id': int(time.time())
         }
-        if not os.path.exists('temp/'):
-            os.makedirs('temp/')
 
         self.sql = None
         self.pg_conn = None
@@ -50,9 +599,14 @@ class rSqoop(object):
         self.s3_env = None
         self.conf = None
         self.s3_conn = None
+        self._schema_cache = {}
+        self._slice_count = None
+        # id(connection) -> time.monotonic() it was last known to be open
+        self._alive_at = {}
 
     def init(self):
         self.conf = Config()
+        self._schema_cache = {}
 
         if self.src_database is not None:
             sql_db_name = self.conf[self.src_database]['db_name']
@@ -66,6 +620,7 @@ class rSqoop(object):
 
             self.sql.conn()
             self.sql.batchOpen()
+            self._alive_at[id(self.sql)] = time.monotonic()
 
         if self.tgt_database is not None:
             pg_db_name = self.conf[self.tgt_database]['db_name']
@@ -79,17 +634,47 @@ class rSqoop(object):
 
             self.pg_conn.conn()
             self.pg_conn.batchOpen()
+            self._alive_at[id(self.pg_conn)] = time.monotonic()
 
         self.aws_access_key = self.conf['general']['aws_access_key']
         self.aws_secret_key = self.conf['general']['aws_secret_key']
 
-        self.s3_environment = S3Interaction(self.aws_access_key, self.aws_secret_key)
+        # one boto3 client for the whole run
+        self.s3_conn = S3Interaction(self.aws_access_key, self.aws_secret_key)
+        self.s3_environment = self.s3_conn
         self.s3_def_bucket = self.conf['general']['temp_bucket']
         self.s3_env = self.conf['general']['env']
-        self.s3_conn = S3Interaction(self.aws_access_key, self.aws_secret_key)
 
         return self
 
+    def _ping(self, conn):
+        """
+        :param conn: PGInteraction or MSSQLInteraction
+        """
+        # fetch_sql streams, fetch_sql_all makes sure the query runs and leaves no pending result
+        conn.fetch_sql_all("select 1")
+        self._alive_at[id(conn)] = time.monotonic()
+
+    def _ensure_alive(self, conn):
+        """
+        Reuses a db connection for the whole run, reconnecting only if it has been dropped
+
+        Connections checked within CONNECTION_CHECK_INTERVAL (e.g. by the
+        keep alive during an extract) aren't pinged again.
+
+        :param conn: PGInteraction or MSSQLInteraction
+        """
+        alive_at = self._alive_at.get(id(conn))
+        if alive_at is not None and time.monotonic() - alive_at < CONNECTION_CHECK_INTERVAL:
+            return
+        try:
+            self._ping(conn)
+        except Exception as e:
+            LOG.l(f'connection lost, reconnecting: {e}')
+            conn.conn()
+            conn.batchOpen()
+            self._alive_at[id(conn)] = time.monotonic()
+
     def get_fields(self, select_fields, schema):
         """
         Switch between custom fields provided by user or use src_table fields
@@ -98,33 +683,29 @@ class rSqoop(object):
         :param schema:
         """
         if select_fields:
+            selected = _index_select_fields(select_fields)
             fields = []
             for field in schema:
-                selected_field = self.get_field_values(select_fields, str(field[0]).lower())
-                if not selected_field:
+                item = selected.get(str(field[0]).lower())
+                if item is None:
                     continue
-                if isinstance(selected_field[0], tuple):
-                    tup = (selected_field[0][1], field[1], field[2], field[3], field[4])
-                else:
-                    tup = (selected_field[0], field[1], field[2], field[3], field[4])
-                fields.append(tup)
+                # (<source_field>, <override_field>) tuples rename the column
+                name = item[-1] if isinstance(item, tuple) else item
+                fields.append((name, field[1], field[2], field[3], field[4]))
         else:
             fields = [(field[0], field[1], field[2], field[3], field[4]) for field in schema]
         return fields
 
-    def get_field_values(self, iterables, key_to_find):
-        """
-        :param iterables: list of tuples
-        :param key_to_find: str
-        :return: list of tuple
-        """
-        return [ i for i in iterables if i == key_to_find or str(i[0]).lower() == str(key_to_find).lower() ]
-
     def get_source_table_schema(self, src_table):
         """
         :param src_table: str
         :return: list
         """
+        # cached per run, clone_staging_table and source_to_s3 both need it
+        cache_key = src_table.lower()
+        if cache_key in self._schema_cache:
+            return self._schema_cache[cache_key]
+
         schema_name = 'public'
 
         if '.' in src_table:
@@ -146,7 +727,9 @@ class rSqoop(object):
             where table_name=lower('{table_name}') and table_schema=lower('{schema_name}')
             order by ordinal_position """
 
-        return self.sql.fetch_sql_all(schema_sql)
+        schema = self.sql.fetch_sql_all(schema_sql)
+        self._schema_cache[cache_key] = schema
+        return schema
 
     def get_select_fields(self, schema, select_fields):
         """
@@ -154,36 +737,21 @@ class rSqoop(object):
         :param select_fields:
         :return: 
         """
-        field_names = []
-        for field in schema:
-            selected_field = self.get_field_values(select_fields, str(field[0]).lower())
-            if not selected_field:
-                continue
-            field_names.append(field[0])
+        selected = _index_select_fields(select_fields)
+        field_names = [field[0] for field in schema if str(field[0]).lower() in selected]
         return ','.join(field_names)
 
-    def clone_staging_table(self, src_table, tgt_table, select_fields=None, incremental=False):
+    def clone_staging_table(self, src_table, tgt_table, select_fields=None, incremental=False,
+                            key_fields=None, date_fields=None):
         """
         Clones src table schema to redshift
 
         :param src_table:
         :param tgt_table:
+        :param key_fields: first staged key becomes the distkey
+        :param date_fields: first staged date field becomes the sortkey
         :return:
         """
-        rs_date_types = ('timestamp with time zone', 'time without time zone',
-                         'datetime', 'smalldatetime', 'date', 'datetime2')
-        rs_char_types = ('timestamp', 'char', 'varchar', 'character', 'nchar', 'bpchar',
-                         'character varying', 'nvarchar', 'text')
-        rs_num_types = ('decimal', 'numeric')
-        rs_smallint_types = ('bit', 'tinyint', 'smallint', 'int2')
-        rs_int_types = ('int', 'integer', 'int4')
-        rs_bigint_types = ('bigint', 'int8')
-        rs_other_types = ('real', 'double precision',
-                          'boolean', 'float4', 'float8',
-                          'float', 'date', 'bool',
-                          'timestamp without time zone')
-        rs_reserved_names = ('partition',)
-
         src_schema = self.get_source_table_schema(src_table)
         schema = self.get_fields(select_fields, src_schema)
 
@@ -200,64 +768,31 @@ class rSqoop(object):
             return src_table, tgt_table
 
         drop_sql = 'drop table if exists ' + tgt_table + ';\n'
-        create_sql = 'create table ' + tgt_table + ' (\n'
-
-        for field in schema:
-            # reserved column names
-            if str(field[0]).lower() not in rs_reserved_names:
-                column_name = field[0]
-            else:
-                column_name = 'v_' + str(field[0])
-
-            # known overrides
-            if field[1] in rs_date_types:
-                data_type = 'timestamp'
-            elif field[1] == 'uuid':
-                data_type = 'varchar(50)'
-            # character precision
-            elif field[1] in rs_char_types:
-                if field[1] == "text" or field[1] == "timestamp":
-                    field_type = "varchar"
-                else:
-                    field_type = field[1]
-
-                if field[1] == "timestamp":
-                    size = 8
-                elif int(field[2]) > 65535:
-                    size = 65535
-                elif int(field[2]) < 0:
-                    size = 2000
-                else:
-                    size = field[2]
-                data_type = ('%s (%s)' % (field_type, size) if field[1] == 'timestamp' or field[2] is not None
-                             else 'varchar(2000)')
-            elif field[1] in rs_smallint_types:
-                data_type = 'smallint'
-            elif field[1] in rs_int_types:
-                data_type = 'integer'
-            elif field[1] in rs_bigint_types:
-                data_type = 'bigint'
-            # numeric precision
-            elif field[1] in rs_num_types:
-                data_type = ('%s (%s,%s)' % (field[1], field[3], field[4]) if field[3] is not None
-                             else field[1])
-            # other mapped types
-            elif field[1] in rs_other_types:
-                data_type = field[1]
-            # uniqueidentifier to varchar(36)
-            elif field[1] == 'uniqueidentifier':
-                data_type = 'varchar(36)'
+        column_names = [field[0] if str(field[0]).lower() not in _RS_RESERVED_NAMES else 'v_' + str(field[0])
+                        for field in schema]
+        staged = {str(name).lower(): name for name in column_names}
+        # only keys that made it into the staged columns, else the create fails
+        dist_key = next((staged[k.lower()] for k in key_fields or () if k.lower() in staged), None)
+        sort_key = next((staged[d.lower()] for d in date_fields or () if d.lower() in staged), None)
+
+        col_parts = []
+        for column_name, field in zip(column_names, schema):
+            handler = _RS_TYPE_HANDLERS.get(field[1])
             # anthing else goes to varchar
-            else:
-                data_type = 'varchar(2000)'
+            data_type = handler(field) if handler else 'varchar(2000)'
+            # leading sortkey column stays raw so range restricted scans keep working
+            encoding = 'raw' if column_name == sort_key else _rs_encoding(data_type)
             # build row
-            create_sql += '\"'+column_name + '\" ' + data_type + ',\n'
+            col_parts.append(f'"{column_name}" {data_type} encode {encoding}')
 
         # append metadata fields
-        create_sql += 'etl_source_system_cd varchar(50),' \
-                      '\netl_row_create_dts timestamp,' \
-                      '\netl_row_update_dts timestamp,' \
-                      '\netl_run_id bigint );\n'
+        col_parts.extend(_RS_META_COLUMNS)
+        table_attrs = ''
+        if dist_key is not None:
+            table_attrs += f'\ndiststyle key distkey("{dist_key}")'
+        if sort_key is not None:
+            table_attrs += f'\nsortkey("{sort_key}")'
+        create_sql = 'create table ' + tgt_table + ' (\n' + ',\n'.join(col_parts) + ' )' + table_attrs + ';\n'
 
         query = drop_sql + create_sql
 
@@ -286,7 +821,9 @@ class rSqoop(object):
                      date_fields=None,
                      delimiter='\t',
                      gzip=True,
-                     source_system_cd=None):
+                     source_system_cd=None,
+                     rows_per_part=None,
+                     use_bcp=False):
         """
         Transfers data from source table to s3
 
@@ -297,6 +834,10 @@ class rSqoop(object):
         :param date_fields:
         :param delimiter:
         :param gzip:
+        :param source_system_cd:
+        :param rows_per_part: split output into files of this many rows and write a manifest
+        :param use_bcp: export with the bcp utility instead of fetching rows through python
+        :return: s3 url of the output file, or of the manifest when rows_per_part is set
         """
 
         tgt_key = tgt_table.replace('.', '-')
@@ -307,66 +848,141 @@ class rSqoop(object):
 
         s3_path = 's3://' + s3_bucket + '/' + s3_key
 
-        filter_str = ''
-
-        if date_fields and self.from_date:
-            date_str = [date + f" > '{self.from_date.strftime('%Y-%m-%d %H:%M')}'" for date in date_fields]
-            filter_str = f"where {' or '.join(date_str)}"
+        filter_str = self.get_date_filter(date_fields)
 
         # for custom field selection
         select_str = '*'
+        src_schema = self.get_source_table_schema(src_table)
         if select_fields:
-            src_schema = self.get_source_table_schema(src_table)
             select_str = self.get_select_fields(src_schema, select_fields)
-
-        ce_sql = f"select {select_str} from {src_table} with (nolock) {filter_str}"
-        LOG.l(ce_sql)
-
-        result = self.sql.fetch_sql(sql=ce_sql, blocksize=20000)
-
-        temp_file = gz.open('temp/%s.txt' % tgt_key, mode='wt', encoding='utf-8') if gzip \
-            else open('temp/%s.txt' % tgt_key, mode='w', encoding='utf-8')
-        LOG.l('exporting to tempfile:' + temp_file.name)
+            selected = _index_select_fields(select_fields)
+            src_schema = [field for field in src_schema if str(field[0]).lower() in selected]
+        encoders = _column_encoders(src_schema) if src_schema else None
 
         self.meta_fields['etl_row_create_dts'] = self.etl_date.strftime('%Y-%m-%d %H:%M:%S')
         self.meta_fields['etl_row_update_dts'] = self.meta_fields['etl_row_create_dts']
 
         # check if there is source_system_cd user input
         self.meta_fields['etl_source_system_cd'] = source_system_cd if source_system_cd else ''
-        meta_values = list(self.meta_fields.values())
-
-        writer = csv.writer(temp_file, delimiter=delimiter, quoting=csv.QUOTE_NONE, quotechar="")
-        for row in result:
-            row_data = []
-            for s in row:
-                if isinstance(s, bool):
-                    s = int(s)
-                else:
-                    s = str(s).replace('\n', ' ').replace('\t', ' ').replace('\r', ' ').replace('\v', ' ')
-                row_data.append(s)
-            writer.writerow(row_data + meta_values)
-        temp_file.flush()
-        temp_file.close()
-        sleep(10)
-
-        # simple quick keep alive for large tables
-        self.pg_conn.conn()
-        self.pg_conn.batchOpen()
-        self.pg_conn.fetch_sql("select 1")
-        self.sql.fetch_sql("select 1")
+        meta_tail = _meta_tail(self.meta_fields.values(), delimiter)
+
+        bcp_path = _find_bcp() if use_bcp and src_schema else None
+        if use_bcp and bcp_path is None:
+            LOG.l('bcp not available for this table, falling back to python export')
+            use_bcp = False
+
+        bcp = None
+        if use_bcp:
+            # sanitizing and metadata columns are done by mssql, rows come out ready to load
+            meta_str = ', '.join("'" + str(v).replace("'", "''") + "'" for v in self.meta_fields.values())
+            select_str = ', '.join(_bcp_select_expr(field) for field in src_schema)
+            ce_sql = f"select {select_str}, {meta_str} from {src_table} with (nolock) {filter_str}"
+            LOG.l(ce_sql)
+            bcp, bcp_messages = self._bcp_queryout(bcp_path, ce_sql, delimiter)
+            # a generator so it can be closed the same way as the prefetch below
+            blocks = (lines for lines in iter(lambda: bcp.stdout.readlines(WRITE_BUFFER_SIZE), []))
+        else:
+            ce_sql = f"select {select_str} from {src_table} with (nolock) {filter_str}"
+            LOG.l(ce_sql)
+            result = self.sql.fetch_sql(sql=ce_sql, blocksize=FETCH_BLOCKSIZE)
+            # fetch runs ahead in its own thread, parts upload in the background
+            blocks = _prefetch(_iter_blocks(result))
 
         LOG.l('upload starting')
-        self.s3_conn.put_file_to_s3(bucket=s3_bucket, key=s3_key + '/output.tsv',
-                               local_filename=temp_file.name)
 
-        s3_full_path = s3_path + '/' + 'output.tsv'
-        LOG.l('upload complete to ' + s3_path)
+        def open_part():
+            # stream straight to s3, no local temp file
+            if rows_per_part:
+                key = s3_key + '/part-%04d.tsv' % (len(parts) + 1) + ('.gz' if gzip else '')
+            else:
+                key = s3_key + '/output.tsv'
+            parts.append(_S3TsvWriter(self.s3_conn.client, s3_bucket, key, meta_tail, delimiter=delimiter, gzip=gzip))
+            return parts[-1]
+
+        parts = []
+        part = None
 
-        if os.path.exists(temp_file.name):
-            os.remove(temp_file.name)
+        # simple quick keep alive for large tables
+        keep_alive = _KeepAlive(lambda: self._ping(self.pg_conn))
+        keep_alive.start()
+        try:
+            for block in blocks:
+                if part is None:
+                    part = open_part()
+                if bcp:
+                    part.write_lines(block)
+                else:
+                    part.write_block(block, encoders)
+                if rows_per_part and part.rows >= rows_per_part:
+                    part.close()
+                    part = None
+            # an empty extract still gets a file for the copy to load
+            if not parts:
+                part = open_part()
+            if bcp:
+                self._bcp_wait(bcp, bcp_messages)
+            if part is not None:
+                part.close()
+        except BaseException:
+            # also on interrupts, an unfinished part must never be published
+            if bcp and bcp.poll() is None:
+                bcp.kill()
+                bcp.wait()
+            for unfinished in parts:
+                unfinished.abort()
+            raise
+        finally:
+            # stops the prefetch thread before the connection is used for anything else
+            blocks.close()
+            keep_alive.stop()
+            if bcp:
+                bcp.stdout.close()
+                bcp_messages.close()
+
+        LOG.l(f'upload complete to {s3_path}, {len(parts)} file(s)')
+
+        if rows_per_part:
+            s3_full_path, _ = self.build_rs_manifest([p.url for p in parts], mfst_bucket=s3_bucket,
+                                                     mfst_key_prefix=s3_key, mfst_filename='manifest')
+        else:
+            s3_full_path = parts[0].url
 
         return s3_full_path
 
+    def _bcp_queryout(self, bcp_path, sql, delimiter='\t'):
+        """
+        Starts bcp exporting the results of sql to its stdout
+
+        :param bcp_path: str, from _find_bcp
+        :param sql: str
+        :param delimiter: str
+        :return: subprocess.Popen and the temp file bcp messages are written to
+        """
+        src_conf = self.conf[self.src_database]
+        server = f"{src_conf['server']},{src_conf.get('port', 1433)}"
+        field_term = delimiter.replace('\t', '\\t')
+        cmd = [bcp_path, sql, 'queryout', '/dev/stdout', '-c', '-t', field_term, '-r', '\\n',
+               '-S', server, '-d', src_conf['db_name'], '-U', src_conf['user'], '-P', src_conf['password'],
+               # progress messages would otherwise be mixed into the data on stdout
+               '-o', '/dev/stderr']
+        LOG.l(f'starting bcp export from {server}')
+        messages = tempfile.TemporaryFile()
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=messages), messages
+
+    @staticmethod
+    def _bcp_wait(bcp, messages):
+        """
+        Waits for bcp to finish and raises with its messages if it failed
+
+        :param bcp: subprocess.Popen from _bcp_queryout
+        :param messages: temp file from _bcp_queryout
+        """
+        returncode = bcp.wait()
+        messages.seek(0)
+        output = messages.read()[-2000:].decode('utf-8', 'replace')
+        if returncode != 0:
+            raise RuntimeError(f'bcp export failed: {output}')
+
     def s3_to_redshift(self,
                         tgt_table,
                         s3_path,
@@ -407,92 +1023,47 @@ class rSqoop(object):
             options.append('REMOVEQUOTES')
 
         opt_str = ' '.join(options) if len(options) > 0 else ''
-        upd_sql = ''
         upd_where = ''
-
-        if not incremental:
-            pre_sql1 = """delete from %(tgt_table)s;\n"""
-
-            if csv_fmt:
-                cp_sql = """
-                COPY %(tgt_table)s from '%(s3_path)s'
-                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
-                dateformat 'YYYY-MM-DD'
-                NULL AS 'None'
-                truncatecolumns
-                maxerror %(maxerror)s
-                %(options)s;\n"""
-            else:
-                cp_sql = """
-                COPY %(tgt_table)s from '%(s3_path)s'
-                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
-                delimiter '%(delimiter)s'
-                dateformat 'YYYY-MM-DD'
-                NULL AS 'None'
-                truncatecolumns
-                maxerror %(maxerror)s
-                %(options)s;\n"""
-        else:
-            pre_sql1 = """
-                drop table if exists tmp;
-                create temporary table tmp (like %(tgt_table)s);\n"""
-
-            if csv_fmt:
-                cp_sql = """
-                COPY tmp from '%(s3_path)s'
-                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
-                dateformat 'YYYY-MM-DD'
-                NULL AS 'None'
-                truncatecolumns
-                maxerror %(maxerror)s %(options)s;\n"""
-            else:
-                cp_sql = """
-                COPY tmp from '%(s3_path)s'
-                CREDENTIALS 'aws_access_key_id=%(aws_id)s;aws_secret_access_key=%(aws_key)s'
-                delimiter '%(delimiter)s'
-                dateformat 'YYYY-MM-DD'
-                NULL AS 'None'
-                truncatecolumns
-                maxerror %(maxerror)s %(options)s;\n"""
-
+        if incremental:
+            sql_template = _CP_SQL_CSV_INC if csv_fmt else _CP_SQL_DELIM_INC
             upd_where = ' and '.join([f'tmp.{x} = {tgt_table}.{x}' for x in key_fields])
-            upd_sql = """
-                delete
-                from %(tgt_table)s
-                where exists
-                  ( select 1
-                    from tmp
-                    where %(upd_where)s);
-                insert into %(tgt_table)s
-                select * from tmp;\n"""
-
-        if csv_fmt:
-            subs = {'tgt_table': tgt_table, 's3_path': s3_path, 'aws_id': self.aws_access_key,
-                    'aws_key': self.aws_secret_key, 'maxerror': maxerror,
-                    'options': opt_str, 'upd_where': upd_where }
         else:
-            subs = {'tgt_table': tgt_table, 's3_path': s3_path, 'aws_id': self.aws_access_key,
-                    'aws_key': self.aws_secret_key, 'maxerror': maxerror,
-                    'options': opt_str, 'upd_where': upd_where,
-                    'delimiter': delimiter}
+            sql_template = _CP_SQL_CSV if csv_fmt else _CP_SQL_DELIM
 
-        sql = (pre_sql1 + cp_sql + upd_sql) % subs
+        subs = {'tgt_table': tgt_table, 's3_path': s3_path, 'aws_id': self.aws_access_key,
+                'aws_key': self.aws_secret_key, 'maxerror': maxerror,
+                'options': opt_str, 'upd_where': upd_where,
+                'delimiter': delimiter}
+
+        sql = sql_template % subs
 
         LOG.l(f'starting copy to {tgt_table}')
         try:
-            self.pg_conn.conn()
-            self.pg_conn.batchOpen()
+            self._ensure_alive(self.pg_conn)
             self.pg_conn.exec_sql(sql)
         except Exception as e:
             LOG.l(f'Error: {e}')
             LOG.l(f'Offending sql: {sql}')
             raise
         LOG.l('granting access')
-        self.grant_std_access(tgt_table)
+        # committed together with the copy
+        self.grant_std_access(tgt_table, commit=False)
+
+        self.pg_conn.batchCommit()
 
         LOG.l('copy complete')
 
-        self.pg_conn.batchCommit()
+    def get_date_filter(self, date_fields):
+        """
+        Where clause limiting an incremental extract to rows changed since from_date
+
+        :param date_fields:
+        :return: str, empty when there is nothing to filter on
+        """
+        if not (date_fields and self.from_date):
+            return ''
+        date_str = [date + f" > '{self.from_date.strftime('%Y-%m-%d %H:%M')}'" for date in date_fields]
+        return f"where {' or '.join(date_str)}"
 
     def get_src_count(self, src_table):
         """
@@ -506,6 +1077,28 @@ class rSqoop(object):
         LOG.l(f'src_cnt: {src_cnt}')
         return src_cnt
 
+    def get_slice_count(self):
+        """
+        Number of slices in the target redshift cluster, copy loads one file per slice in parallel
+
+        :return: int
+        """
+        if self._slice_count is None:
+            self._slice_count = self.pg_conn.fetch_sql_all("select count(1) from stv_slices")[0][0]
+        return self._slice_count
+
+    def get_rows_per_part(self, row_cnt):
+        """
+        Splits an extract so every slice gets a file, without going below MIN_ROWS_PER_PART
+
+        :param row_cnt: rows in the extract
+        :return: int, or None when the extract is small enough for a single file
+        """
+        if row_cnt <= MIN_ROWS_PER_PART:
+            return None
+        slices = max(self.get_slice_count(), 1)
+        return max(-(-row_cnt // slices), MIN_ROWS_PER_PART)
+
     def check_tgt_count(self, src_cnt, tgt_table, pct_threshold=0.01):
         """
         Basic source to target data quality checks
@@ -549,35 +1142,28 @@ class rSqoop(object):
         mfst_filename = mfst_filename if mfst_filename \
             else datetime.now().strftime("%Y%m%d-%H%M%S%f")
 
-        s3_bucket = self.s3_environment.get_bucket(mfst_bucket)
-
         LOG.l(mfst_filename)
-        entries = []
-        for url in url_list:
-            s3_file = {}
-            s3_file['url'] = url
-            s3_file["mandatory"] = True
-            entries.append(s3_file)
+        entries = [{'url': url, 'mandatory': True} for url in url_list]
         mfst_key_name = mfst_key_prefix + '/' + mfst_filename
-        mfst = {"entries":entries}
-        mfst_str = str(json.dumps(mfst))
-        s3_bucket.new_key(mfst_key_name).set_contents_from_string(mfst_str)
+        mfst = {"entries": entries}
+        self.s3_conn.client.put_object(Bucket=mfst_bucket, Key=mfst_key_name, Body=json.dumps(mfst).encode('utf-8'),
+                                       ContentType='application/json')
         mfst_url = f"s3://{mfst_bucket}/{mfst_key_name}"
         return mfst_url, mfst
 
-    def grant_std_access(self, entity):
+    def grant_std_access(self, entity, commit=True):
         """
         Grants standard groups to entity
 
         :param entity:
+        :param commit: False to leave the grant in the caller's transaction
         :return:
         """
         grant = f"""
-            grant all on {entity} to etl_user;
-            grant all on {entity} to group ro_users;
-            grant all on {entity} to group power_users;\n"""
+            grant all on {entity} to etl_user, group ro_users, group power_users;\n"""
         self.pg_conn.exec_sql(grant)
-        self.pg_conn.batchCommit()
+        if commit:
+            self.pg_conn.batchCommit()
 
     def stage_to_redshift(self,
                           src_table,
@@ -589,7 +1175,8 @@ class rSqoop(object):
                           remove_quotes=False,
                           key_fields=None,
                           select_fields=None,
-                          source_system_cd=None):
+                          source_system_cd=None,
+                          use_bcp=False):
         """
         Clones table from source, stages to s3, and then copies into redshift
 
@@ -603,12 +1190,18 @@ class rSqoop(object):
         :param key_fields:
         :param select_fields:
         :param source_system_cd:
+        :param use_bcp:
         :return:
         """
         LOG.l(f'\n\n--starting staging of {src_table}')
 
+        # connections may have idled out while a previous table was loading
+        self._ensure_alive(self.sql)
+        self._ensure_alive(self.pg_conn)
+
         # 1. clone tables (if doesn't already exist)
-        src_name, tgt_name = self.clone_staging_table(src_table, tgt_table, select_fields, incremental=incremental)
+        src_name, tgt_name = self.clone_staging_table(src_table, tgt_table, select_fields, incremental=incremental,
+                                                      key_fields=key_fields, date_fields=date_fields)
 
         LOG.l(f'loading to {tgt_name}')
 
@@ -618,16 +1211,21 @@ class rSqoop(object):
         # 2. get source count
         src_cnt = self.get_src_count(src_table)
 
-        # 3. copy data to s3
+        # 3. copy data to s3, split so every redshift slice gets a file to load.
+        # incremental extracts are sized from the full count rather than paying for
+        # another scan, an overestimate only means fewer, larger files
+        rows_per_part = self.get_rows_per_part(src_cnt)
         s3_path = self.source_to_s3(src_table, tgt_table,
                                     select_fields=select_fields,
                                     date_fields=date_fields, delimiter=delimiter,
-                                    gzip=gzip, source_system_cd=source_system_cd)
+                                    gzip=gzip, source_system_cd=source_system_cd,
+                                    rows_per_part=rows_per_part, use_bcp=use_bcp)
 
         # 4. copy s3 data to redshift
         self.s3_to_redshift(tgt_table=tgt_table,
                             s3_path=s3_path,
                             gzip=gzip,
+                            manifest=rows_per_part is not None,
                             delimiter=delimiter,
                             remove_quotes=remove_quotes,
                             key_fields=key_fields,
@@ -639,6 +1237,53 @@ class rSqoop(object):
         LOG.l('--end staging of table\n\n')
 
 
+def stage_tables(src_database, tgt_database, tables, workers=4, from_date=None, **kwargs):
+    """
+    Stages (source, target) table pairs in parallel, see rSqoop.stage_to_redshift for kwargs
+
+    Each worker thread has its own rSqoop and connections, reused for every
+    table it stages. Pairs loading the same target share its s3 key and
+    table, so they are staged in order by a single worker, and a failure
+    skips the rest of that target. Other targets still run, the first
+    failure is raised once they are done.
+
+    :param src_database:
+    :param tgt_database:
+    :param tables: list of tuple [(<source_table>, <target_table>)]
+    :param workers: int, number of tables staged at once
+    :param from_date:
+    :return:
+    """
+    # every table of the run shares the same run id and load dates
+    run = rSqoop(src_database, tgt_database, from_date)
+    local = threading.local()
+
+    def stage(group):
+        for source_table, target_table in group:
+            if not hasattr(local, 'rsqoop'):
+                local.rsqoop = rSqoop(src_database, tgt_database, from_date).init()
+                local.rsqoop.etl_date = run.etl_date
+                local.rsqoop.meta_fields['etl_run_id'] = run.meta_fields['etl_run_id']
+            LOG.l(f'Staging source table {source_table} to Redshift table {target_table}')
+            try:
+                local.rsqoop.stage_to_redshift(source_table, target_table, **kwargs)
+            except Exception:
+                # connections may be left in an aborted transaction, the next table opens new ones
+                del local.rsqoop
+                raise
+
+    groups = {}
+    for source_table, target_table in tables:
+        groups.setdefault(target_table.lower(), []).append((source_table, target_table))
+    if not groups:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+        futures = [executor.submit(stage, group) for group in groups.values()]
+    for future in futures:
+        future.result()
+
+
 if __name__ == '__main__':
     aparser = argparse.ArgumentParser()
     aparser.add_argument('-sc', '--source-conn', help="""source connection""", required=True)
@@ -653,22 +1298,27 @@ if __name__ == '__main__':
     aparser.add_argument('-df', '--date-fields', nargs='*', help='date fields for incremental (list)', required=False)
     aparser.add_argument('-f', '--from-date', type=parser.parse, help='from date for incremental', required=False)
     aparser.add_argument('-ss', '--source-system', help='source system cd', required=False)
+    aparser.add_argument('-b', '--bcp', default=False, action='store_true', help='export with bcp when available', required=False)
+    aparser.add_argument('-w', '--workers', type=int, default=4, help='number of tables staged in parallel', required=False)
     args = aparser.parse_args()
 
-    r = rSqoop(args.source_conn, args.target_conn, args.from_date).init()
-
-    for i in range(len(args.source_tables)):
-        source_table = args.source_tables[i]
-        target_table = args.target_tables[i]
-        LOG.l(f'Staging source table {source_table} to Redshift table {target_table}')
-        r.stage_to_redshift(
-            source_table,
-            target_table,
-            incremental=args.incremental,
-            gzip=args.gzip,
-            date_fields=args.date_fields,
-            remove_quotes=args.remove_quotes,
-            select_fields=args.select_fields,
-            key_fields=args.key_fields,
-            source_system_cd=args.source_system
-        )
+    if len(args.source_tables) != len(args.target_tables):
+        aparser.error('--source-tables and --target-tables need the same number of tables')
+    if args.workers < 1:
+        aparser.error('--workers needs to be at least 1')
+
+    stage_tables(
+        args.source_conn,
+        args.target_conn,
+        list(zip(args.source_tables, args.target_tables)),
+        workers=args.workers,
+        from_date=args.from_date,
+        incremental=args.incremental,
+        gzip=args.gzip,
+        date_fields=args.date_fields,
+        remove_quotes=args.remove_quotes,
+        select_fields=args.select_fields,
+        key_fields=args.key_fields,
+        source_system_cd=args.source_system,
+        use_bcp=args.bcp
+    )
@@ -1,7 +1,15 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+from datetime import datetime
+import gc
+import gzip
+import json
+import os
+import threading
+import time
 import unittest
 
-from rsqoop_runner.module import rSqoop
+from rsqoop_runner.module import rSqoop, stage_tables, _bcp_select_expr, _column_encoders, _sanitize_block, _S3MultipartWriter, \
+    _S3TsvWriter
 
 """
  You can use this test as reference on how to start using rSqoop in your code.
@@ -17,12 +25,26 @@ class TestMain(unittest.TestCase):
         """
         self.main = rSqoop('WebDB', 'cosmo')
 
+    def mock_connections(self, schema, rows=()):
+        """
+            mocks the source, target and s3 connections, source tables have schema and return rows
+        """
+        self.main.sql = MagicMock()
+        self.main.sql.fetch_sql_all.return_value = schema
+        self.main.sql.fetch_sql.return_value = iter(rows)
+        self.main.pg_conn = MagicMock()
+        self.main.s3_conn = MagicMock()
+        self.main.s3_conn.client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        self.main.conf = {'general': {'temp_bucket': 'test'}}
+        self.main.s3_env = 'test'
+
     def test_initial(self):
         """
             main.stage_to_redshift(mssql table, postgres/redshift table)
         """
         self.main.sql = MagicMock()
-        self.main.sql.fetch_sql_all.side_effect = [[('UserPreferenceTypeId', 'int', None, 10, 0), ('PreferenceName', 'varchar', 100, None, None), ('PreferenceValueDataType', 'varchar', 50, None, None), ('UserPreferenceCategoryId', 'int', None, 10, 0), ('IsMaintainHistory', 'bit', None, None, None), ('CreatedOn', 'datetime', None, None, None), ('ModifiedOn', 'datetime', None, None, None), ('CreatedBy', 'varchar', 50, None, None), ('ModifiedBy', 'varchar', 50, None, None), ('IsActive', 'bit', None, None, None)],
+        # liveness ping, source schema, source count
+        self.main.sql.fetch_sql_all.side_effect = [[(1,)], [('UserPreferenceTypeId', 'int', None, 10, 0), ('PreferenceName', 'varchar', 100, None, None), ('PreferenceValueDataType', 'varchar', 50, None, None), ('UserPreferenceCategoryId', 'int', None, 10, 0), ('IsMaintainHistory', 'bit', None, None, None), ('CreatedOn', 'datetime', None, None, None), ('ModifiedOn', 'datetime', None, None, None), ('CreatedBy', 'varchar', 50, None, None), ('ModifiedBy', 'varchar', 50, None, None), ('IsActive', 'bit', None, None, None)],
                                                     [(3,)]]
         self.main.pg_conn = MagicMock()
         self.main.pg_conn.fetch_sql_all.return_value = [(3,)]
@@ -53,6 +75,250 @@ class TestMain(unittest.TestCase):
         print('test_get_fields', fields)
         self.assertTrue(len(fields) == 2)
 
+    def test_get_fields_override(self):
+        select_fields = [('PreferenceName', 'preference_nm'), 'isactive']
+        schema = [('UserPreferenceTypeId', 'int', None, 10, 0), ('PreferenceName', 'varchar', 100, None, None),
+                  ('IsActive', 'bit', None, None, None)]
+        fields = self.main.get_fields(select_fields, schema)
+        self.assertEqual(fields, [('preference_nm', 'varchar', 100, None, None),
+                                  ('isactive', 'bit', None, None, None)])
+        self.assertEqual(self.main.get_select_fields(schema, select_fields), 'PreferenceName,IsActive')
+
+    def test_source_table_schema_cached(self):
+        select_fields = [('PreferenceName', 'preference_nm'), 'isactive']
+        self.mock_connections([('UserPreferenceTypeId', 'int', None, 10, 0),
+                               ('PreferenceName', 'varchar', 100, None, None),
+                               ('IsActive', 'bit', None, None, None)])
+
+        self.main.clone_staging_table('dbo.User_UserPreferenceType', 'edw_landing.stg_table', select_fields)
+        self.main.source_to_s3('dbo.User_UserPreferenceType', 'edw_landing.stg_table', select_fields=select_fields)
+        schema_queries = [c for c in self.main.sql.fetch_sql_all.call_args_list if 'information_schema' in c[0][0]]
+        self.assertEqual(len(schema_queries), 1)
+        self.assertIn('dbo.user_userpreferencetype', self.main._schema_cache)
+
+        with patch('rsqoop_runner.module.Config'), patch('rsqoop_runner.module.MSSQLInteraction'), \
+                patch('rsqoop_runner.module.PGInteraction'), patch('rsqoop_runner.module.S3Interaction'):
+            self.main.init()
+        self.assertEqual(self.main._schema_cache, {})
+
+    def test_build_rs_manifest(self):
+        self.main.s3_conn = MagicMock()
+        url_list = ['s3://test/rsqoop/part-0001.tsv.gz', 's3://test/rsqoop/part-0002.tsv.gz']
+        mfst_url, mfst = self.main.build_rs_manifest(url_list, mfst_bucket='test', mfst_key_prefix='rsqoop',
+                                                     mfst_filename='manifest')
+        self.assertEqual(mfst_url, 's3://test/rsqoop/manifest')
+        self.assertEqual([entry['url'] for entry in mfst['entries']], url_list)
+        kwargs = self.main.s3_conn.client.put_object.call_args[1]
+        self.assertEqual(kwargs['Key'], 'rsqoop/manifest')
+        self.assertEqual(json.loads(kwargs['Body']), mfst)
+
+    def test_get_rows_per_part(self):
+        self.main.pg_conn = MagicMock()
+        self.main.pg_conn.fetch_sql_all.return_value = [(16,)]
+        self.assertIsNone(self.main.get_rows_per_part(3))
+        self.main.pg_conn.fetch_sql_all.assert_not_called()
+        self.assertEqual(self.main.get_rows_per_part(10000000), 625000)
+        self.assertEqual(self.main.get_rows_per_part(500000), 100000)
+        self.main.pg_conn.fetch_sql_all.assert_called_once()
+
+    def test_get_date_filter(self):
+        self.assertEqual(self.main.get_date_filter(['ModifiedOn']), '')
+        self.main.from_date = datetime(2020, 1, 2, 3, 4)
+        self.assertEqual(self.main.get_date_filter(['ModifiedOn', 'CreatedOn']),
+                         "where ModifiedOn > '2020-01-02 03:04' or CreatedOn > '2020-01-02 03:04'")
+
+    def test_ensure_alive_reconnects(self):
+        conn = MagicMock()
+        conn.fetch_sql_all.side_effect = IOError('connection dropped')
+        self.main._ensure_alive(conn)
+        conn.fetch_sql_all.assert_called_once_with("select 1")
+        conn.conn.assert_called_once()
+        conn.batchOpen.assert_called_once()
+        # checked recently, not pinged again
+        self.main._ensure_alive(conn)
+        conn.fetch_sql_all.assert_called_once()
+
+    def test_grant_std_access(self):
+        self.main.pg_conn = MagicMock()
+        self.main.grant_std_access('edw_landing.stg_table', commit=False)
+        self.main.pg_conn.exec_sql.assert_called_once()
+        self.assertIn('to etl_user, group ro_users, group power_users',
+                      self.main.pg_conn.exec_sql.call_args[0][0])
+        self.main.pg_conn.batchCommit.assert_not_called()
+
+    def test_clone_staging_table(self):
+        self.main.sql = MagicMock()
+        self.main.sql.fetch_sql_all.return_value = [('UserPreferenceTypeId', 'int', None, 10, 0),
+                                                    ('PreferenceName', 'varchar', 100, None, None),
+                                                    ('IsActive', 'boolean', None, None, None),
+                                                    ('ModifiedOn', 'datetime', None, None, None)]
+        self.main.pg_conn = MagicMock()
+        self.main.clone_staging_table('dbo.UserPreferenceType', 'edw_landing.stg_table',
+                                      key_fields=['userpreferencetypeid'], date_fields=['ModifiedOn'])
+        create_sql = self.main.pg_conn.exec_sql.call_args[0][0]
+        self.assertIn('"UserPreferenceTypeId" integer encode az64,\n'
+                      '"PreferenceName" varchar (100) encode zstd,\n'
+                      '"IsActive" boolean encode raw,\n'
+                      '"ModifiedOn" timestamp encode raw,\n', create_sql)
+        self.assertIn('etl_run_id bigint encode az64 )\n'
+                      'diststyle key distkey("UserPreferenceTypeId")\n'
+                      'sortkey("ModifiedOn");', create_sql)
+
+    def test_s3_multipart_writer(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+
+        def upload_part(PartNumber, **kwargs):
+            # later parts finish first
+            time.sleep(0.01 * max(4 - PartNumber, 0))
+            return {'ETag': f'etag-{PartNumber}'}
+        client.upload_part.side_effect = upload_part
+
+        data = os.urandom(50000)
+        stream = _S3MultipartWriter(client, 'test', 'rsqoop/output.tsv.gz', part_size=10000)
+        with gzip.GzipFile(fileobj=stream, mode='wb') as out_file:
+            out_file.write(data)
+        stream.complete()
+
+        parts = client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], list(range(1, len(parts) + 1)))
+        self.assertEqual([part['ETag'] for part in parts], [f'etag-{n}' for n in range(1, len(parts) + 1)])
+        bodies = sorted((c[1]['PartNumber'], c[1]['Body']) for c in client.upload_part.call_args_list)
+        self.assertEqual(gzip.decompress(b''.join(body for _, body in bodies)), data)
+        client.abort_multipart_upload.assert_not_called()
+
+    def test_s3_multipart_writer_abort(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.side_effect = IOError('upload failed')
+
+        stream = _S3MultipartWriter(client, 'test', 'rsqoop/output.tsv', part_size=10)
+        stream.write(b'x' * 25)
+        with self.assertRaises(IOError):
+            stream.complete()
+        client.abort_multipart_upload.assert_called_once_with(Bucket='test', Key='rsqoop/output.tsv',
+                                                              UploadId='upload')
+        client.complete_multipart_upload.assert_not_called()
+        self.assertTrue(stream.closed)
+
+    def test_s3_tsv_writer_unclosed_aborts(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.return_value = {'ETag': 'etag'}
+
+        out_file = _S3TsvWriter(client, 'test', 'rsqoop/output.tsv.gz', '\tetl\n')
+        out_file.write_block([(1, 'line')])
+        del out_file
+        gc.collect()
+        client.abort_multipart_upload.assert_called_once()
+        client.complete_multipart_upload.assert_not_called()
+
+        out_file = _S3TsvWriter(client, 'test', 'rsqoop/output.tsv.gz', '\tetl\n')
+        out_file.write_block([(1, 'line')])
+        out_file.close()
+        client.complete_multipart_upload.assert_called_once()
+        self.assertEqual(gzip.decompress(client.upload_part.call_args[1]['Body']), b'1\tline\tetl\n')
+
+    def test_source_to_s3_failure_stops_prefetch(self):
+        self.mock_connections([('UserPreferenceTypeId', 'int', None, 10, 0)], [(i,) for i in range(200000)])
+
+        with patch('rsqoop_runner.module._sanitize_block', side_effect=ValueError('bad block')):
+            with self.assertRaises(ValueError):
+                self.main.source_to_s3('dbo.User_UserPreferenceType', 'edw_landing.stg_table')
+        self.assertEqual(threading.active_count(), 1)
+        self.main.s3_conn.client.abort_multipart_upload.assert_called_once()
+
+    def test_bcp_select_expr(self):
+        self.assertEqual(_bcp_select_expr(('IsActive', 'bit', None, None, None)),
+                         "isnull(cast([IsActive] as varchar(1)), 'None')")
+        self.assertEqual(_bcp_select_expr(('ModifiedOn', 'datetime', None, None, None)),
+                         "isnull(convert(varchar(33), [ModifiedOn], 121), 'None')")
+        self.assertEqual(_bcp_select_expr(('Amount', 'float', None, 53, None)),
+                         "isnull(convert(varchar(30), [Amount], 2), 'None')")
+        self.assertEqual(_bcp_select_expr(('Preference]Name', 'varchar', 100, None, None)),
+                         "isnull(replace(replace(replace(replace(cast([Preference]]Name] as nvarchar(max)), "
+                         "char(10), ' '), char(13), ' '), char(9), ' '), char(11), ' '), 'None')")
+
+    def test_source_to_s3_bcp_fallback(self):
+        self.mock_connections([('UserPreferenceTypeId', 'int', None, 10, 0)], [(1,), (2,)])
+
+        with patch('rsqoop_runner.module._find_bcp', return_value=None), \
+                patch('rsqoop_runner.module.subprocess.Popen') as popen:
+            s3_path = self.main.source_to_s3('dbo.User_UserPreferenceType', 'edw_landing.stg_table',
+                                             gzip=False, use_bcp=True)
+        popen.assert_not_called()
+        self.main.sql.fetch_sql.assert_called_once()
+        self.assertEqual(s3_path, 's3://test/rsqoop/test/edw_landing-stg_table/output.tsv')
+        body = self.main.s3_conn.client.upload_part.call_args[1]['Body'].decode('utf-8')
+        self.assertEqual([line.split('\t')[0] for line in body.splitlines()], ['1', '2'])
+
+    def test_source_to_s3_bcp_failure(self):
+        self.mock_connections([('UserPreferenceTypeId', 'int', None, 10, 0)])
+        bcp, messages = MagicMock(), MagicMock()
+        bcp.stdout.readlines.side_effect = IOError('pipe broken')
+        bcp.poll.return_value = None
+        self.main._bcp_queryout = MagicMock(return_value=(bcp, messages))
+
+        with patch('rsqoop_runner.module._find_bcp', return_value='/opt/mssql-tools/bin/bcp'):
+            with self.assertRaises(IOError):
+                self.main.source_to_s3('dbo.User_UserPreferenceType', 'edw_landing.stg_table', use_bcp=True)
+        bcp.kill.assert_called_once()
+        bcp.wait.assert_called_once()
+        bcp.stdout.close.assert_called_once()
+        messages.close.assert_called_once()
+        self.main.sql.fetch_sql.assert_not_called()
+
+    def test_stage_tables(self):
+        staged = []
+
+        def stage_to_redshift(rsqoop, src_table, tgt_table, **kwargs):
+            staged.append((threading.get_ident(), rsqoop, src_table, tgt_table, kwargs))
+            time.sleep(0.01)
+
+        tables = [('dbo.User_A', 'edw_landing.stg_user'), ('dbo.Preference', 'edw_landing.stg_preference'),
+                  ('dbo.User_B', 'EDW_LANDING.STG_USER')]
+        with patch.object(rSqoop, 'init', lambda rsqoop: rsqoop), \
+                patch.object(rSqoop, 'stage_to_redshift', stage_to_redshift):
+            stage_tables('WebDB', 'cosmo', tables, workers=2, incremental=True)
+
+        self.assertEqual(len(staged), 3)
+        # same target, staged in order by one worker
+        same_target = [entry for entry in staged if entry[3].lower() == 'edw_landing.stg_user']
+        self.assertEqual([entry[2] for entry in same_target], ['dbo.User_A', 'dbo.User_B'])
+        self.assertEqual(same_target[0][0], same_target[1][0])
+        self.assertIs(same_target[0][1], same_target[1][1])
+        self.assertEqual(len({entry[1].meta_fields['etl_run_id'] for entry in staged}), 1)
+        self.assertEqual(len({entry[1].etl_date for entry in staged}), 1)
+        self.assertTrue(all(entry[4] == {'incremental': True} for entry in staged))
+
+    def test_stage_tables_failure(self):
+        staged = []
+
+        def stage_to_redshift(rsqoop, src_table, tgt_table, **kwargs):
+            staged.append(rsqoop)
+            if src_table == 'dbo.User_A':
+                raise IOError('copy failed')
+
+        tables = [('dbo.User_A', 'edw_landing.stg_user'), ('dbo.User_B', 'edw_landing.stg_user'),
+                  ('dbo.Preference', 'edw_landing.stg_preference')]
+        with patch.object(rSqoop, 'init', lambda rsqoop: rsqoop), \
+                patch.object(rSqoop, 'stage_to_redshift', stage_to_redshift):
+            with self.assertRaises(IOError):
+                stage_tables('WebDB', 'cosmo', tables, workers=1)
+
+        # the rest of the failed target is skipped, the next target gets a new rSqoop
+        self.assertEqual(len(staged), 2)
+        self.assertIsNot(staged[0], staged[1])
+
+    def test_sanitize_block(self):
+        schema = [('PreferenceName', 'varchar', 100, None, None), ('IsActive', 'bit', None, None, None),
+                  ('UserPreferenceTypeId', 'int', None, 10, 0)]
+        block = [('line\nbreak\tand tab', True, 1), (None, None, None), ('sep\x1f\r', False, 2)]
+        text = _sanitize_block(block, '\t', '\tetl\n', _column_encoders(schema))
+        self.assertEqual(text, 'line break and tab\t1\t1\tetl\n'
+                               'None\tNone\tNone\tetl\n'
+                               'sep\x1f \t0\t2\tetl\n')
+
 
 if __name__ == '__main__':
     unittest.main()